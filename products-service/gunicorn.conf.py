@@ -0,0 +1,15 @@
+import os
+
+from prometheus_client import multiprocess
+
+bind = '0.0.0.0:5002'
+workers = int(os.getenv('GUNICORN_WORKERS', '4'))
+worker_class = 'gevent'
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+
+def post_worker_init(worker):
+    from main import refresh_product_count
+    refresh_product_count()
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,20 +1,71 @@
+# Make sockets and psycopg2 cooperative. Under gunicorn this module is only
+# imported by the gevent worker, which has already patched the stdlib; the
+# patch here covers direct runs, and psycogreen is needed in both cases
+from gevent import monkey
+monkey.patch_all()
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
 from flask import Flask, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import CollectorRegistry, REGISTRY, multiprocess
 from datetime import datetime
 from functools import wraps
+from operator import attrgetter
+import gevent
+import orjson
 import os
+import psycopg2
 import time
+import threading
+import fcntl
+import redis
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv(
+DATABASE_URL = os.getenv(
     'DATABASE_URL', 
     'postgresql://postgres:postgres@db:5432/userdb'
 )
+DB_CONNECT_TIMEOUT = 5
+
+def connect_db():
+    """Open a psycopg2 connection, giving up after DB_CONNECT_TIMEOUT seconds"""
+    # libpq ignores connect_timeout once psycogreen makes the connect
+    # asynchronous, so the deadline is enforced on the gevent side
+    timeout = gevent.Timeout(
+        DB_CONNECT_TIMEOUT,
+        psycopg2.OperationalError('timeout expired')
+    )
+    with timeout:
+        return psycopg2.connect(DATABASE_URL)
+
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 20,
+    'max_overflow': 20,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+    'pool_timeout': 10,
+    'creator': connect_db
+}
 
 db = SQLAlchemy(app)
 
+# Redis connection
+redis_url = os.getenv('REDIS_URL', 'redis://redis:6379/0')
+try:
+    redis_pool = redis.ConnectionPool.from_url(
+        redis_url, max_connections=50, decode_responses=False
+    )
+    redis_client = redis.Redis(connection_pool=redis_pool)
+    redis_client.ping()
+    print("Redis connection established!")
+except Exception as e:
+    print(f"Redis connection failed: {e}")
+    redis_client = None
+
 # Prometheus metrics
 REQUEST_COUNT = Counter(
     'products_http_requests_total',
@@ -36,17 +87,40 @@ HTTP_ERRORS = Counter(
 
 SERVICE_UP = Gauge(
     'products_service_up',
-    'Service availability (1 = up, 0 = down)'
+    'Service availability (1 = up, 0 = down)',
+    multiprocess_mode='livemax'
 )
 
 ACTIVE_PRODUCTS = Gauge(
     'active_products_total',
-    'Total number of products in database'
+    'Total number of products in database',
+    multiprocess_mode='livemax'
+)
+
+CACHE_HITS = Counter(
+    'products_cache_hits_total',
+    'Total cache hits',
+    ['endpoint']
+)
+
+CACHE_MISSES = Counter(
+    'products_cache_misses_total',
+    'Total cache misses',
+    ['endpoint']
 )
 
 # Set service as up
 SERVICE_UP.set(1)
 
+# Under gunicorn every worker writes its samples to PROMETHEUS_MULTIPROC_DIR,
+# so /metrics aggregates them instead of reporting the answering worker only
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+if PROMETHEUS_MULTIPROC_DIR:
+    METRICS_REGISTRY = CollectorRegistry()
+    multiprocess.MultiProcessCollector(METRICS_REGISTRY)
+else:
+    METRICS_REGISTRY = REGISTRY
+
 class Product(db.Model):
     __tablename__ = 'products'
     id = db.Column(db.Integer, primary_key=True)
@@ -57,19 +131,58 @@ class Product(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def to_dict(self):
+        i, n, d, p, s, c = _product_fields(self)
         return {
-            'id': self.id,
-            'name': self.name,
-            'description': self.description,
-            'price': self.price,
-            'stock': self.stock,
-            'created_at': self.created_at.isoformat()
+            'id': i,
+            'name': n,
+            'description': d,
+            'price': p,
+            'stock': s,
+            'created_at': c
         }
 
+_product_fields = attrgetter('id', 'name', 'description', 'price', 'stock', 'created_at')
+
+def serialize_products(rows):
+    """Build response dicts from (id, name, description, price, stock, created_at) rows"""
+    return [
+        {
+            'id': i,
+            'name': n,
+            'description': d,
+            'price': p,
+            'stock': s,
+            'created_at': c
+        }
+        for i, n, d, p, s, c in rows
+    ]
+
+def json_bytes(obj):
+    """Serialize obj to JSON bytes with orjson"""
+    return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC)
+
+def ojson(obj):
+    """Serialize obj with orjson into a JSON response"""
+    return app.response_class(json_bytes(obj), mimetype='application/json')
+
+# Labelled metric children, reused across requests
+_labelled_cache = {}
+TRACKED_ENDPOINTS = set()
+
+def labelled(metric, *values):
+    """Return the child of metric for the given label values"""
+    key = (metric, values)
+    child = _labelled_cache.get(key)
+    if child is None:
+        child = _labelled_cache[key] = metric.labels(*values)
+    return child
+
 def track_metrics(f):
+    TRACKED_ENDPOINTS.add(f.__name__)
+    
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        start_time = time.time()
+        start = time.perf_counter()
         endpoint = request.endpoint or 'unknown'
         method = request.method
         
@@ -77,18 +190,18 @@ def track_metrics(f):
             response = f(*args, **kwargs)
             status = response[1] if isinstance(response, tuple) else 200
             
-            REQUEST_COUNT.labels(method=method, endpoint=endpoint, status=status).inc()
-            REQUEST_LATENCY.labels(method=method, endpoint=endpoint).observe(time.time() - start_time)
+            labelled(REQUEST_COUNT, method, endpoint, status).inc()
             
             if status >= 400:
-                HTTP_ERRORS.labels(method=method, endpoint=endpoint, status=status).inc()
+                labelled(HTTP_ERRORS, method, endpoint, status).inc()
             
             return response
         except Exception as e:
-            REQUEST_COUNT.labels(method=method, endpoint=endpoint, status=500).inc()
-            HTTP_ERRORS.labels(method=method, endpoint=endpoint, status=500).inc()
-            REQUEST_LATENCY.labels(method=method, endpoint=endpoint).observe(time.time() - start_time)
+            labelled(REQUEST_COUNT, method, endpoint, 500).inc()
+            labelled(HTTP_ERRORS, method, endpoint, 500).inc()
             raise e
+        finally:
+            labelled(REQUEST_LATENCY, method, endpoint).observe(time.perf_counter() - start)
     
     return decorated_function
 
@@ -106,17 +219,47 @@ def wait_for_db():
             time.sleep(1)
     return False
 
+# Refresh interval for the count gauge, matching the 5s scrape in prometheus.yaml
+COUNT_REFRESH_INTERVAL = 5
+
 def update_product_count():
     try:
-        count = Product.query.count()
+        count = db.session.execute(
+            db.select(db.func.count()).select_from(Product)
+        ).scalar()
         ACTIVE_PRODUCTS.set(count)
     except:
         pass
 
+_count_refresh_lock = None
+
+def holds_count_refresh_lock():
+    """Elect a single worker per container to run the count query"""
+    global _count_refresh_lock
+    if _count_refresh_lock is not None or not PROMETHEUS_MULTIPROC_DIR:
+        return True
+    lock_file = open(os.path.join(PROMETHEUS_MULTIPROC_DIR, 'count_refresh.lock'), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    # Kept open for the life of the worker; the lock is freed when it exits
+    _count_refresh_lock = lock_file
+    return True
+
+def refresh_product_count():
+    """Refresh the products count gauge in the background every interval"""
+    if holds_count_refresh_lock():
+        with app.app_context():
+            update_product_count()
+    timer = threading.Timer(COUNT_REFRESH_INTERVAL, refresh_product_count)
+    timer.daemon = True
+    timer.start()
+
 @app.route('/metrics')
 def metrics():
-    update_product_count()
-    return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+    return generate_latest(METRICS_REGISTRY), 200, {'Content-Type': CONTENT_TYPE_LATEST}
 
 @app.route('/health')
 @track_metrics
@@ -126,15 +269,42 @@ def health():
 @app.route('/products', methods=['GET'])
 @track_metrics
 def get_products():
-    products = Product.query.all()
-    update_product_count()
-    return jsonify([p.to_dict() for p in products])
+    conn = db.engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT id, name, description, price, stock, created_at FROM products')
+        rows = cur.fetchall()
+        cur.close()
+    finally:
+        conn.close()
+    return ojson(serialize_products(rows))
 
 @app.route('/products/<int:id>', methods=['GET'])
 @track_metrics
 def get_product(id):
+    cache_key = f'product:{id}'
+    
+    if redis_client:
+        try:
+            cached_data = redis_client.get(cache_key)
+            if cached_data:
+                CACHE_HITS.labels(endpoint='get_product').inc()
+                return app.response_class(cached_data, mimetype='application/json')
+        except Exception as e:
+            print(f"Redis error: {e}")
+    
+    CACHE_MISSES.labels(endpoint='get_product').inc()
+    
     product = Product.query.get_or_404(id)
-    return jsonify(product.to_dict())
+    product_json = json_bytes(product.to_dict())
+    
+    if redis_client:
+        try:
+            redis_client.setex(cache_key, 60, product_json)
+        except Exception as e:
+            print(f"Failed to cache data: {e}")
+    
+    return app.response_class(product_json, mimetype='application/json')
 
 @app.route('/products', methods=['POST'])
 @track_metrics
@@ -152,8 +322,7 @@ def create_product():
         )
         db.session.add(product)
         db.session.commit()
-        update_product_count()
-        return jsonify(product.to_dict()), 201
+        return ojson(product.to_dict()), 201
     except ValueError as e:
         return jsonify({'error': 'Invalid price or stock value'}), 400
 
@@ -163,13 +332,32 @@ def delete_product(id):
     product = Product.query.get_or_404(id)
     db.session.delete(product)
     db.session.commit()
-    update_product_count()
+    
+    if redis_client:
+        try:
+            redis_client.delete(f'product:{id}')
+        except Exception as e:
+            print(f"Failed to invalidate cache: {e}")
+    
     return '', 204
 
-if __name__ == '__main__':
+def warm_metric_labels():
+    """Create latency children for every tracked route up front"""
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint in TRACKED_ENDPOINTS:
+            for method in rule.methods - {'HEAD', 'OPTIONS'}:
+                labelled(REQUEST_LATENCY, method, rule.endpoint)
+
+warm_metric_labels()
+
+def init_db():
+    """Wait for the database and create the tables"""
     with app.app_context():
         wait_for_db()
         db.create_all()
         print("Products table created/verified!")
-        update_product_count()
-    app.run(host='0.0.0.0', port=5002, debug=True)
\ No newline at end of file
+
+if __name__ == '__main__':
+    init_db()
+    refresh_product_count()
+    app.run(host='0.0.0.0', port=5002, debug=(os.getenv('ENVIRONMENT') != 'production'))
\ No newline at end of file
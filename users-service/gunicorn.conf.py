@@ -0,0 +1,15 @@
+import os
+
+from prometheus_client import multiprocess
+
+bind = '0.0.0.0:5000'
+workers = int(os.getenv('GUNICORN_WORKERS', '4'))
+worker_class = 'gevent'
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+
+def post_worker_init(worker):
+    from secure_main import refresh_user_count
+    refresh_user_count()
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,17 +1,52 @@
+# Make sockets and psycopg2 cooperative. Under gunicorn this module is only
+# imported by the gevent worker, which has already patched the stdlib; the
+# patch here covers direct runs, and psycogreen is needed in both cases
+from gevent import monkey
+monkey.patch_all()
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
 from flask import Flask, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST
 from datetime import datetime
 from functools import wraps
+from operator import attrgetter
+import gevent
+import orjson
 import os
+import psycopg2
 import time
+import threading
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv(
+DATABASE_URL = os.getenv(
     'DATABASE_URL', 
     'postgresql://postgres:postgres@db:5432/userdb'
 )
+DB_CONNECT_TIMEOUT = 5
+
+def connect_db():
+    """Open a psycopg2 connection, giving up after DB_CONNECT_TIMEOUT seconds"""
+    # libpq ignores connect_timeout once psycogreen makes the connect
+    # asynchronous, so the deadline is enforced on the gevent side
+    timeout = gevent.Timeout(
+        DB_CONNECT_TIMEOUT,
+        psycopg2.OperationalError('timeout expired')
+    )
+    with timeout:
+        return psycopg2.connect(DATABASE_URL)
+
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 20,
+    'max_overflow': 20,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+    'pool_timeout': 10,
+    'creator': connect_db
+}
 
 db = SQLAlchemy(app)
 
@@ -55,17 +90,43 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def to_dict(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'email': self.email,
-            'created_at': self.created_at.isoformat()
-        }
+        i, n, e, c = _user_fields(self)
+        return {'id': i, 'name': n, 'email': e, 'created_at': c}
+
+_user_fields = attrgetter('id', 'name', 'email', 'created_at')
+
+def serialize_users(rows):
+    """Build response dicts from (id, name, email, created_at) rows"""
+    return [
+        {'id': i, 'name': n, 'email': e, 'created_at': c}
+        for i, n, e, c in rows
+    ]
+
+def ojson(obj):
+    """Serialize obj with orjson into a JSON response"""
+    return app.response_class(
+        orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC),
+        mimetype='application/json'
+    )
+
+# Labelled metric children, reused across requests
+_labelled_cache = {}
+TRACKED_ENDPOINTS = set()
+
+def labelled(metric, *values):
+    """Return the child of metric for the given label values"""
+    key = (metric, values)
+    child = _labelled_cache.get(key)
+    if child is None:
+        child = _labelled_cache[key] = metric.labels(*values)
+    return child
 
 def track_metrics(f):
+    TRACKED_ENDPOINTS.add(f.__name__)
+    
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        start_time = time.time()
+        start = time.perf_counter()
         endpoint = request.endpoint or 'unknown'
         method = request.method
         
@@ -74,18 +135,18 @@ def track_metrics(f):
             status = response[1] if isinstance(response, tuple) else 200
             
             # Track metrics
-            REQUEST_COUNT.labels(method=method, endpoint=endpoint, status=status).inc()
-            REQUEST_LATENCY.labels(method=method, endpoint=endpoint).observe(time.time() - start_time)
+            labelled(REQUEST_COUNT, method, endpoint, status).inc()
             
             if status >= 400:
-                HTTP_ERRORS.labels(method=method, endpoint=endpoint, status=status).inc()
+                labelled(HTTP_ERRORS, method, endpoint, status).inc()
             
             return response
         except Exception as e:
-            REQUEST_COUNT.labels(method=method, endpoint=endpoint, status=500).inc()
-            HTTP_ERRORS.labels(method=method, endpoint=endpoint, status=500).inc()
-            REQUEST_LATENCY.labels(method=method, endpoint=endpoint).observe(time.time() - start_time)
+            labelled(REQUEST_COUNT, method, endpoint, 500).inc()
+            labelled(HTTP_ERRORS, method, endpoint, 500).inc()
             raise e
+        finally:
+            labelled(REQUEST_LATENCY, method, endpoint).observe(time.perf_counter() - start)
     
     return decorated_function
 
@@ -103,16 +164,28 @@ def wait_for_db():
             time.sleep(1)
     return False
 
+# Refresh interval for the count gauge, matching the 5s scrape in prometheus.yaml
+COUNT_REFRESH_INTERVAL = 5
+
 def update_user_count():
     try:
-        count = User.query.count()
+        count = db.session.execute(
+            db.select(db.func.count()).select_from(User)
+        ).scalar()
         ACTIVE_USERS.set(count)
     except:
         pass
 
+def refresh_user_count():
+    """Refresh the users count gauge in the background every interval"""
+    with app.app_context():
+        update_user_count()
+    timer = threading.Timer(COUNT_REFRESH_INTERVAL, refresh_user_count)
+    timer.daemon = True
+    timer.start()
+
 @app.route('/metrics')
 def metrics():
-    update_user_count()
     return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
 
 @app.route('/health')
@@ -129,15 +202,21 @@ def health():
 @app.route('/users', methods=['GET'])
 @track_metrics
 def get_users():
-    users = User.query.all()
-    update_user_count()
-    return jsonify([u.to_dict() for u in users])
+    conn = db.engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT id, name, email, created_at FROM users')
+        rows = cur.fetchall()
+        cur.close()
+    finally:
+        conn.close()
+    return ojson(serialize_users(rows))
 
 @app.route('/users/<int:id>', methods=['GET'])
 @track_metrics
 def get_user(id):
     user = User.query.get_or_404(id)
-    return jsonify(user.to_dict())
+    return ojson(user.to_dict())
 
 @app.route('/users', methods=['POST'])
 @track_metrics
@@ -149,8 +228,7 @@ def create_user():
     user = User(name=data['name'], email=data['email'])
     db.session.add(user)
     db.session.commit()
-    update_user_count()
-    return jsonify(user.to_dict()), 201
+    return ojson(user.to_dict()), 201
 
 @app.route('/users/<int:id>', methods=['PUT'])
 @track_metrics
@@ -160,7 +238,7 @@ def update_user(id):
     user.name = data.get('name', user.name)
     user.email = data.get('email', user.email)
     db.session.commit()
-    return jsonify(user.to_dict())
+    return ojson(user.to_dict())
 
 @app.route('/users/<int:id>', methods=['DELETE'])
 @track_metrics
@@ -168,13 +246,25 @@ def delete_user(id):
     user = User.query.get_or_404(id)
     db.session.delete(user)
     db.session.commit()
-    update_user_count()
     return '', 204
 
-if __name__ == '__main__':
+def warm_metric_labels():
+    """Create latency children for every tracked route up front"""
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint in TRACKED_ENDPOINTS:
+            for method in rule.methods - {'HEAD', 'OPTIONS'}:
+                labelled(REQUEST_LATENCY, method, rule.endpoint)
+
+warm_metric_labels()
+
+def init_db():
+    """Wait for the database and create the tables"""
     with app.app_context():
         wait_for_db()
         db.create_all()
         print("Database tables created/verified!")
-        update_user_count()
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+
+if __name__ == '__main__':
+    init_db()
+    refresh_user_count()
+    app.run(host='0.0.0.0', port=5000, debug=(os.getenv('ENVIRONMENT') != 'production'))
\ No newline at end of file
@@ -1,15 +1,31 @@
+# Make sockets and psycopg2 cooperative. Under gunicorn this module is only
+# imported by the gevent worker, which has already patched the stdlib; the
+# patch here covers direct runs, and psycogreen is needed in both cases
+from gevent import monkey
+monkey.patch_all()
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
 from flask import Flask, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_cors import CORS
 from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import CollectorRegistry, REGISTRY, multiprocess
 from datetime import datetime
 from functools import wraps
+from itertools import chain
+from operator import attrgetter
+from urllib.parse import unquote_to_bytes
+import gevent
+import orjson
 import os
+import psycopg2
 import time
+import threading
+import fcntl
 import redis
-import json
 import re
 import logging
 
@@ -17,11 +33,37 @@ app = Flask(__name__)
 
 # Security Configuration
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key')
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv(
+DATABASE_URL = os.getenv(
     'DATABASE_URL', 
     'postgresql://app_user:app_secure_password@db:5432/userdb'
 )
+DB_CONNECT_TIMEOUT = 5
+
+def connect_db():
+    """Open a psycopg2 connection, giving up after DB_CONNECT_TIMEOUT seconds"""
+    # libpq ignores connect_timeout once psycogreen makes the connect
+    # asynchronous, so the deadline is enforced on the gevent side
+    timeout = gevent.Timeout(
+        DB_CONNECT_TIMEOUT,
+        psycopg2.OperationalError('timeout expired')
+    )
+    with timeout:
+        return psycopg2.connect(DATABASE_URL)
+
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 20,
+    'max_overflow': 20,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+    'pool_timeout': 10,
+    'creator': connect_db
+}
+
+# Environment, read once at startup
+_IS_PROD = os.getenv('ENVIRONMENT') == 'production'
+_INSTANCE_ID = os.getenv('INSTANCE_ID', 'unknown')
 
 # Logging configuration
 logging.basicConfig(
@@ -34,7 +76,11 @@ db = SQLAlchemy(app)
 
 # CORS Configuration - restrictive
 cors_origins = os.getenv('CORS_ORIGINS', 'http://localhost:8080').split(',')
-CORS(app, origins=cors_origins, supports_credentials=True)
+CORS(
+    app,
+    resources={r'/users.*': {'origins': cors_origins}},
+    supports_credentials=True
+)
 
 # Rate Limiting
 limiter = Limiter(
@@ -50,7 +96,10 @@ limiter = Limiter(
 # Redis connection
 redis_url = os.getenv('REDIS_URL', 'redis://redis:6379/0')
 try:
-    redis_client = redis.from_url(redis_url, decode_responses=True)
+    redis_pool = redis.ConnectionPool.from_url(
+        redis_url, max_connections=50, decode_responses=False
+    )
+    redis_client = redis.Redis(connection_pool=redis_pool)
     redis_client.ping()
     logger.info("Redis connection established!")
 except Exception as e:
@@ -78,12 +127,14 @@ HTTP_ERRORS = Counter(
 
 SERVICE_UP = Gauge(
     'service_up',
-    'Service availability (1 = up, 0 = down)'
+    'Service availability (1 = up, 0 = down)',
+    multiprocess_mode='livemax'
 )
 
 ACTIVE_USERS = Gauge(
     'active_users_total',
-    'Total number of users in database'
+    'Total number of users in database',
+    multiprocess_mode='livemax'
 )
 
 CACHE_HITS = Counter(
@@ -106,85 +157,166 @@ SECURITY_EVENTS = Counter(
 
 SERVICE_UP.set(1)
 
+# Under gunicorn every worker writes its samples to PROMETHEUS_MULTIPROC_DIR,
+# so /metrics aggregates them instead of reporting the answering worker only
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+if PROMETHEUS_MULTIPROC_DIR:
+    METRICS_REGISTRY = CollectorRegistry()
+    multiprocess.MultiProcessCollector(METRICS_REGISTRY)
+else:
+    METRICS_REGISTRY = REGISTRY
+
 class User(db.Model):
     __tablename__ = 'users'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    email = db.Column(db.String(100), unique=True, nullable=False)
+    email = db.Column(db.String(100), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_users_email', 'email', unique=True),
+    )
+
     def to_dict(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'email': self.email,
-            'created_at': self.created_at.isoformat()
-        }
+        i, n, e, c = _user_fields(self)
+        return {'id': i, 'name': n, 'email': e, 'created_at': c}
+
+_user_fields = attrgetter('id', 'name', 'email', 'created_at')
+
+def serialize_users(rows):
+    """Build response dicts from (id, name, email, created_at) rows"""
+    return [
+        {'id': i, 'name': n, 'email': e, 'created_at': c}
+        for i, n, e, c in rows
+    ]
 
 # Security Middleware
+SUSPICIOUS_PATTERNS = [
+    "'", '"', '--', ';', 
+    'DROP', 'DELETE FROM', 'INSERT INTO',
+    '<script', 'javascript:', 'onerror=',
+    '../', '..\\', 'etc/passwd'
+]
+
+# Single case-insensitive alternation so the raw payload is scanned once
+SUSPICIOUS_RE = re.compile(
+    b'|'.join(re.escape(p.encode()) for p in SUSPICIOUS_PATTERNS),
+    re.IGNORECASE
+)
+SCAN_BODY_LIMIT = 65536
+SCAN_QUERY_LIMIT = 4096
+
+# Endpoints polled by Prometheus and health checks
+PROBE_PATHS = ('/metrics', '/health')
+
 @app.before_request
 def security_logging():
     """Log suspicious requests"""
-    suspicious_patterns = [
-        "'", '"', '--', ';', 
-        'DROP', 'DELETE FROM', 'INSERT INTO',
-        '<script', 'javascript:', 'onerror=',
-        '../', '..\\', 'etc/passwd'
-    ]
+    if request.path in PROBE_PATHS:
+        return
+    if request.method == 'GET' and not request.args:
+        return
+    # JSON payloads are parsed and validated by the handlers themselves
+    if request.is_json:
+        return
     
-    request_data = str(request.data) + str(request.args) + str(request.form)
-    
-    for pattern in suspicious_patterns:
-        if pattern.lower() in request_data.lower():
-            SECURITY_EVENTS.labels(type='suspicious_pattern').inc()
-            logger.warning(
-                f"Suspicious request from {request.remote_addr}: "
-                f"Pattern '{pattern}' detected in {request.method} {request.path}"
+    # Only buffer bodies of known, bounded size; larger ones are not scanned
+    content_length = request.content_length
+    if content_length is not None and content_length <= SCAN_BODY_LIMIT:
+        body = request.get_data(cache=True)
+    else:
+        body = b''
+        if content_length:
+            logger.info(
+                f"Skipping body scan for {request.method} {request.path}: "
+                f"{content_length} bytes exceeds {SCAN_BODY_LIMIT}"
             )
+    
+    if request.mimetype == 'application/x-www-form-urlencoded':
+        body = unquote_to_bytes(body.replace(b'+', b' '))
+    query = unquote_to_bytes(request.query_string[:SCAN_QUERY_LIMIT].replace(b'+', b' '))
+    
+    detected = {
+        m.group(0).lower().decode()
+        for m in chain(SUSPICIOUS_RE.finditer(body), SUSPICIOUS_RE.finditer(query))
+    }
+    for pattern in detected:
+        SECURITY_EVENTS.labels(type='suspicious_pattern').inc()
+        logger.warning(
+            f"Suspicious request from {request.remote_addr}: "
+            f"Pattern '{pattern}' detected in {request.method} {request.path}"
+        )
 
 @app.after_request
 def security_headers(response):
     """Add security headers"""
+    if request.path in PROBE_PATHS:
+        return response
+    
     response.headers['X-Frame-Options'] = 'SAMEORIGIN'
     response.headers['X-Content-Type-Options'] = 'nosniff'
     response.headers['X-XSS-Protection'] = '1; mode=block'
     response.headers['Strict-Transport-Security'] = 'max-age=31536000; includeSubDomains'
-    response.headers['X-Instance-ID'] = os.getenv('INSTANCE_ID', 'unknown')
+    response.headers['X-Instance-ID'] = _INSTANCE_ID
     
     # Remove sensitive headers in production
-    if os.getenv('ENVIRONMENT') == 'production':
+    if _IS_PROD:
         response.headers.pop('Server', None)
     
     return response
 
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+# Only allow letters, spaces, hyphens, and apostrophes, 2-100 characters
+_NAME_RE = re.compile(r"^[a-zA-ZÀ-ÿ\s'-]{2,100}\Z")
+
 def validate_email(email):
     """Validate email format"""
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    return _EMAIL_RE.match(email) is not None
 
 def validate_name(name):
     """Validate name format"""
     if not name or not isinstance(name, str):
         return False
-    if len(name) < 2 or len(name) > 100:
-        return False
-    # Only allow letters, spaces, hyphens, and apostrophes
-    pattern = r"^[a-zA-ZÀ-ÿ\s'-]+$"
-    return re.match(pattern, name) is not None
+    return _NAME_RE.match(name) is not None
+
+# Potentially dangerous characters, stripped in a single translate pass
+_SANITIZE_TRANS = str.maketrans('', '', '<>"\';')
 
 def sanitize_input(data):
     """Sanitize user input"""
     if isinstance(data, str):
-        # Remove potentially dangerous characters
-        dangerous_chars = ['<', '>', '"', "'", ';', '--']
-        for char in dangerous_chars:
-            data = data.replace(char, '')
+        data = data.translate(_SANITIZE_TRANS)
+        # Single hyphens are valid in names, only the SQL comment marker goes
+        if '--' in data:
+            data = data.replace('--', '')
     return data
 
+def json_bytes(obj):
+    """Serialize obj to JSON bytes with orjson"""
+    return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC)
+
+def ojson(obj):
+    """Serialize obj with orjson into a JSON response"""
+    return app.response_class(json_bytes(obj), mimetype='application/json')
+
+# Labelled metric children, reused across requests
+_labelled_cache = {}
+TRACKED_ENDPOINTS = set()
+
+def labelled(metric, *values):
+    """Return the child of metric for the given label values"""
+    key = (metric, values)
+    child = _labelled_cache.get(key)
+    if child is None:
+        child = _labelled_cache[key] = metric.labels(*values)
+    return child
+
 def track_metrics(f):
+    TRACKED_ENDPOINTS.add(f.__name__)
+    
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        start_time = time.time()
+        start = time.perf_counter()
         endpoint = request.endpoint or 'unknown'
         method = request.method
         
@@ -192,29 +324,41 @@ def track_metrics(f):
             response = f(*args, **kwargs)
             status = response[1] if isinstance(response, tuple) else 200
             
-            REQUEST_COUNT.labels(method=method, endpoint=endpoint, status=status).inc()
-            REQUEST_LATENCY.labels(method=method, endpoint=endpoint).observe(time.time() - start_time)
+            labelled(REQUEST_COUNT, method, endpoint, status).inc()
             
             if status >= 400:
-                HTTP_ERRORS.labels(method=method, endpoint=endpoint, status=status).inc()
+                labelled(HTTP_ERRORS, method, endpoint, status).inc()
             
             return response
         except Exception as e:
-            REQUEST_COUNT.labels(method=method, endpoint=endpoint, status=500).inc()
-            HTTP_ERRORS.labels(method=method, endpoint=endpoint, status=500).inc()
-            REQUEST_LATENCY.labels(method=method, endpoint=endpoint).observe(time.time() - start_time)
+            labelled(REQUEST_COUNT, method, endpoint, 500).inc()
+            labelled(HTTP_ERRORS, method, endpoint, 500).inc()
             
             # Log error but don't expose details to client
             logger.error(f"Error in {endpoint}: {str(e)}")
             
             # Generic error message in production
-            if os.getenv('ENVIRONMENT') == 'production':
+            if _IS_PROD:
                 return jsonify({'error': 'Internal server error'}), 500
             else:
                 return jsonify({'error': str(e)}), 500
+        finally:
+            labelled(REQUEST_LATENCY, method, endpoint).observe(time.perf_counter() - start)
     
     return decorated_function
 
+def invalidate_cache(*keys):
+    """Delete cache keys in a single pipelined round-trip"""
+    if not redis_client:
+        return
+    try:
+        with redis_client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.delete(key)
+            pipe.execute()
+    except Exception as e:
+        logger.error(f"Failed to invalidate cache: {e}")
+
 def wait_for_db():
     max_retries = 30
     retry_count = 0
@@ -229,26 +373,55 @@ def wait_for_db():
             time.sleep(1)
     return False
 
+# Refresh interval for the count gauge, matching the 5s scrape in prometheus.yaml
+COUNT_REFRESH_INTERVAL = 5
+
 def update_user_count():
     try:
-        count = User.query.count()
+        count = db.session.execute(
+            db.select(db.func.count()).select_from(User)
+        ).scalar()
         ACTIVE_USERS.set(count)
     except:
         pass
 
+_count_refresh_lock = None
+
+def holds_count_refresh_lock():
+    """Elect a single worker per container to run the count query"""
+    global _count_refresh_lock
+    if _count_refresh_lock is not None or not PROMETHEUS_MULTIPROC_DIR:
+        return True
+    lock_file = open(os.path.join(PROMETHEUS_MULTIPROC_DIR, 'count_refresh.lock'), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    # Kept open for the life of the worker; the lock is freed when it exits
+    _count_refresh_lock = lock_file
+    return True
+
+def refresh_user_count():
+    """Refresh the users count gauge in the background every interval"""
+    if holds_count_refresh_lock():
+        with app.app_context():
+            update_user_count()
+    timer = threading.Timer(COUNT_REFRESH_INTERVAL, refresh_user_count)
+    timer.daemon = True
+    timer.start()
+
 @app.route('/metrics')
 def metrics():
-    update_user_count()
-    return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+    return generate_latest(METRICS_REGISTRY), 200, {'Content-Type': CONTENT_TYPE_LATEST}
 
 @app.route('/health')
 @track_metrics
 @limiter.exempt
 def health():
-    instance_id = os.getenv('INSTANCE_ID', 'unknown')
     return jsonify({
         'status': 'healthy',
-        'instance': instance_id,
+        'instance': _INSTANCE_ID,
         'service': 'users'
     })
 
@@ -263,26 +436,33 @@ def get_users():
             cached_data = redis_client.get(cache_key)
             if cached_data:
                 CACHE_HITS.labels(endpoint='get_users').inc()
-                return jsonify({
-                    'data': json.loads(cached_data),
-                    'source': 'cache'
-                })
+                return app.response_class(cached_data, mimetype='application/json')
         except Exception as e:
             logger.error(f"Redis error: {e}")
     
     CACHE_MISSES.labels(endpoint='get_users').inc()
     
-    users = User.query.all()
-    users_data = [u.to_dict() for u in users]
+    conn = db.engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT id, name, email, created_at FROM users')
+        rows = cur.fetchall()
+        cur.close()
+    finally:
+        conn.close()
+    users_data = serialize_users(rows)
     
     if redis_client:
         try:
-            redis_client.setex(cache_key, 60, json.dumps(users_data))
+            # Cache the complete response body so hits need no JSON work
+            redis_client.setex(cache_key, 60, json_bytes({
+                'data': users_data,
+                'source': 'cache'
+            }))
         except Exception as e:
             logger.error(f"Failed to cache data: {e}")
     
-    update_user_count()
-    return jsonify({
+    return ojson({
         'data': users_data,
         'source': 'database'
     })
@@ -294,8 +474,29 @@ def get_user(id):
     if id <= 0:
         return jsonify({'error': 'Invalid user ID'}), 400
     
+    cache_key = f'user:{id}'
+    
+    if redis_client:
+        try:
+            cached_data = redis_client.get(cache_key)
+            if cached_data:
+                CACHE_HITS.labels(endpoint='get_user').inc()
+                return app.response_class(cached_data, mimetype='application/json')
+        except Exception as e:
+            logger.error(f"Redis error: {e}")
+    
+    CACHE_MISSES.labels(endpoint='get_user').inc()
+    
     user = User.query.get_or_404(id)
-    return jsonify(user.to_dict())
+    user_json = json_bytes(user.to_dict())
+    
+    if redis_client:
+        try:
+            redis_client.setex(cache_key, 60, user_json)
+        except Exception as e:
+            logger.error(f"Failed to cache data: {e}")
+    
+    return app.response_class(user_json, mimetype='application/json')
 
 @app.route('/users', methods=['POST'])
 @track_metrics
@@ -320,29 +521,28 @@ def create_user():
         SECURITY_EVENTS.labels(type='invalid_email').inc()
         return jsonify({'error': 'Invalid email format'}), 400
     
+    email = data['email'].lower().strip()
+    
     # Check if email already exists
-    existing_user = User.query.filter_by(email=data['email']).first()
-    if existing_user:
+    email_taken = db.session.execute(
+        db.select(db.exists().where(User.email == email))
+    ).scalar()
+    if email_taken:
         return jsonify({'error': 'Email already exists'}), 409
     
     try:
         user = User(
             name=sanitize_input(data['name']),
-            email=data['email'].lower().strip()
+            email=email
         )
         db.session.add(user)
         db.session.commit()
         
         # Invalidate cache
-        if redis_client:
-            try:
-                redis_client.delete('users:all')
-            except Exception as e:
-                logger.error(f"Failed to invalidate cache: {e}")
+        invalidate_cache('users:all')
         
-        update_user_count()
         logger.info(f"User created: {user.email}")
-        return jsonify(user.to_dict()), 201
+        return ojson(user.to_dict()), 201
         
     except Exception as e:
         db.session.rollback()
@@ -376,11 +576,10 @@ def update_user(id):
     try:
         db.session.commit()
         
-        if redis_client:
-            redis_client.delete('users:all')
+        invalidate_cache(f'user:{id}', 'users:all')
         
         logger.info(f"User updated: {user.id}")
-        return jsonify(user.to_dict())
+        return ojson(user.to_dict())
         
     except Exception as e:
         db.session.rollback()
@@ -400,10 +599,8 @@ def delete_user(id):
         db.session.delete(user)
         db.session.commit()
         
-        if redis_client:
-            redis_client.delete('users:all')
+        invalidate_cache(f'user:{id}', 'users:all')
         
-        update_user_count()
         logger.info(f"User deleted: {id}")
         return '', 204
         
@@ -427,10 +624,23 @@ def internal_error(error):
     logger.error(f"Internal error: {error}")
     return jsonify({'error': 'Internal server error'}), 500
 
-if __name__ == '__main__':
+def warm_metric_labels():
+    """Create latency children for every tracked route up front"""
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint in TRACKED_ENDPOINTS:
+            for method in rule.methods - {'HEAD', 'OPTIONS'}:
+                labelled(REQUEST_LATENCY, method, rule.endpoint)
+
+warm_metric_labels()
+
+def init_db():
+    """Wait for the database and create the tables"""
     with app.app_context():
         wait_for_db()
         db.create_all()
         logger.info("Database tables created/verified!")
-        update_user_count()
-    app.run(host='0.0.0.0', port=5000, debug=(os.getenv('ENVIRONMENT') != 'production'))
\ No newline at end of file
+
+if __name__ == '__main__':
+    init_db()
+    refresh_user_count()
+    app.run(host='0.0.0.0', port=5000, debug=not _IS_PROD)
\ No newline at end of file